@@ -162,10 +162,25 @@ checkplot pkl my-project/awesome-objects
 import os
 import os.path
 import sys
-import glob
+import math
+import fnmatch
 import json
 import argparse
 
+# os.scandir is only available on Python >= 3.5
+try:
+    from os import scandir
+    HAVESCANDIR = True
+except ImportError:
+    HAVESCANDIR = False
+
+# orjson is a lot faster than json for dumping large checkplot lists
+try:
+    import orjson
+    HAVEORJSON = True
+except:
+    HAVEORJSON = False
+
 # suppress warnings
 import warnings
 warnings.filterwarnings('ignore')
@@ -194,6 +209,21 @@ def dict_get(datadict, keylist):
 
 
 
+def write_json(outdict, outjson):
+    '''
+    This writes outdict to the JSON file outjson, using orjson if available.
+
+    '''
+
+    if HAVEORJSON:
+        with open(outjson,'wb') as outfd:
+            outfd.write(orjson.dumps(outdict))
+    else:
+        with open(outjson,'w') as outfd:
+            json.dump(outdict, outfd)
+
+
+
 def key_worker(task):
     '''
     This gets the required keys from the requested file.
@@ -387,12 +417,32 @@ def main():
 
     currdir = os.getcwd()
 
-    checkplotglob = os.path.join(checkplotbasedir,
-                                 '%s.%s' % (fileglob, checkplotext))
-
-    print('searching for checkplots: %s' % checkplotglob)
-
-    searchresults = glob.glob(checkplotglob)
+    checkplotglob = '%s.%s' % (fileglob, checkplotext)
+
+    print('searching for checkplots: %s' %
+          os.path.join(checkplotbasedir, checkplotglob))
+
+    # list the directory with scandir and match the file names against the
+    # glob directly. like glob.glob, this skips hidden files
+    if os.path.isdir(checkplotbasedir) and HAVESCANDIR:
+        searchresults = [
+            os.path.join(checkplotbasedir, x.name)
+            for x in scandir(checkplotbasedir)
+            if (not x.name.startswith('.') and
+                fnmatch.fnmatch(x.name, checkplotglob) and
+                x.is_file())
+        ]
+    # this does the same thing for older Pythons
+    elif os.path.isdir(checkplotbasedir):
+        searchresults = [
+            os.path.join(checkplotbasedir, x)
+            for x in os.listdir(checkplotbasedir)
+            if (not x.startswith('.') and
+                fnmatch.fnmatch(x, checkplotglob) and
+                os.path.isfile(os.path.join(checkplotbasedir, x)))
+        ]
+    else:
+        searchresults = []
 
     if searchresults:
 
@@ -609,12 +659,12 @@ def main():
                       'sorting checkplot pickles '
                       'using usual alphanumeric sort...')
 
-                searchresults = sorted(searchresults)
+                # sort in place so we don't make a copy of a long list
+                searchresults.sort()
                 sortkey = 'filename'
                 sortorder = 'asc'
 
-        nchunks = int(len(searchresults)/splitout) + 1
-
+        nchunks = int(math.ceil(len(searchresults)/float(splitout)))
         searchchunks = [searchresults[x*splitout:x*splitout+splitout] for x
                         in range(nchunks)]
 
@@ -653,17 +703,16 @@ def main():
                 # if it's OK to overwrite, then do so
                 if answer and answer == 'y':
 
-                    with open(outjson,'w') as outfd:
-                        print('WRN! completely overwriting '
-                              'existing checkplot list %s' % outjson)
-                        outdict = {
-                            'checkplots':chunk,
-                            'nfiles':len(chunk),
-                            'sortkey':sortkey,
-                            'sortorder':sortorder,
-                            'filterstatements':filterstatements
-                        }
-                        json.dump(outdict,outfd)
+                    print('WRN! completely overwriting '
+                          'existing checkplot list %s' % outjson)
+                    outdict = {
+                        'checkplots':chunk,
+                        'nfiles':len(chunk),
+                        'sortkey':sortkey,
+                        'sortorder':sortorder,
+                        'filterstatements':filterstatements
+                    }
+                    write_json(outdict, outjson)
 
                 # if it's not OK to overwrite, then
                 else:
@@ -684,19 +733,17 @@ def main():
                     indict['filterstatements'] = filterstatements
 
                     # write the updated to back to the file
-                    with open(outjson,'w') as outfd:
-                        json.dump(indict, outfd)
+                    write_json(indict, outjson)
 
             # if this is a new output file
             else:
 
-                with open(outjson,'w') as outfd:
-                    outdict = {'checkplots':chunk,
-                               'nfiles':len(chunk),
-                               'sortkey':sortkey,
-                               'sortorder':sortorder,
-                               'filterstatements':filterstatements}
-                    json.dump(outdict,outfd)
+                outdict = {'checkplots':chunk,
+                           'nfiles':len(chunk),
+                           'sortkey':sortkey,
+                           'sortorder':sortorder,
+                           'filterstatements':filterstatements}
+                write_json(outdict, outjson)
 
             if os.path.exists(outjson):
                 print('checkplot file list written to %s' % outjson)
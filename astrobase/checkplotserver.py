@@ -204,6 +204,10 @@ def main():
             LOGGER.error(helpmsg)
             sys.exit(1)
 
+    # the handlers check if a requested checkplot is in the list using this,
+    # instead of going through the list every time
+    CHECKPLOTLIST['checkplots_set'] = frozenset(CHECKPLOTLIST['checkplots'])
+
     ###################################
     ## PERSISTENT CHECKPLOT EXECUTOR ##
     ###################################
@@ -232,6 +236,14 @@ def main():
           'cplistfile':cplistfile,
           'executor':EXECUTOR,
           'readonly':READONLY}),
+        (r'/plot/(.+)/([\w-]+)',
+         cphandlers.CheckplotPlotHandler,
+         {'currentdir':CURRENTDIR,
+          'assetpath':ASSETPATH,
+          'cplist':CHECKPLOTLIST,
+          'cplistfile':cplistfile,
+          'executor':EXECUTOR,
+          'readonly':READONLY}),
         (r'/cp/?(.*)',
          cphandlers.CheckplotHandler,
          {'currentdir':CURRENTDIR,
@@ -24,6 +24,7 @@ import hashlib
 import logging
 from datetime import time
 import time
+from collections import OrderedDict
 
 try:
     from cStringIO import StringIO as strio
@@ -55,6 +56,54 @@ class FrontendEncoder(json.JSONEncoder):
 # tornado.web.RequestHandler.write(dict) is called.
 json._default_encoder = FrontendEncoder()
 
+# orjson is a lot faster than json for dumping the large dicts (with their
+# base64 encoded plots) that we send to the frontend, so use it if we can
+try:
+    import orjson
+    HAVEORJSON = True
+except:
+    HAVEORJSON = False
+
+def _orjson_default(obj):
+    '''
+    This handles the objects that orjson can't serialize by itself.
+
+    '''
+
+    if isinstance(obj, ndarray):
+        return obj.tolist()
+    elif isinstance(obj, bytes):
+        return obj.decode()
+    else:
+        raise TypeError
+
+def _frontend_json(obj):
+    '''
+    This dumps obj to JSON for the frontend, using orjson if it's available.
+
+    '''
+
+    if HAVEORJSON:
+        return orjson.dumps(
+            obj,
+            default=_orjson_default,
+            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        )
+    else:
+        return json.dumps(obj)
+
+def _frontend_json_loads(jsonstr):
+    '''
+    This loads a JSON string sent by the frontend, using orjson if it's
+    available.
+
+    '''
+
+    if HAVEORJSON:
+        return orjson.loads(jsonstr)
+    else:
+        return json.loads(jsonstr)
+
 #############
 ## LOGGING ##
 #############
@@ -267,6 +316,310 @@ CPTOOLMAP = {
 
 
 
+##########################
+## CHECKPLOT LOAD CACHE ##
+##########################
+
+def _b64_to_png(b64plot):
+    '''
+    This turns the base64 encoded plot in a checkplot pickle back into PNG
+    bytes.
+
+    '''
+
+    if b64plot is None:
+        return None
+    else:
+        return base64.b64decode(b64plot)
+
+
+
+def _load_checkplot(cpfpath, ploturl):
+    '''This loads a checkplot pickle and gets the things the frontend needs.
+
+    Returns a tuple of two items. The first is the 'result' item of the JSON
+    sent by CheckplotHandler.get, with the plots replaced by their URLs of the
+    form {ploturl}/{plotkey}. The second is a dict of the PNG bytes for each
+    plotkey, which are served by CheckplotPlotHandler.get.
+
+    This is run by the checkplotserver's executor. Use _get_checkplot below to
+    get these from the cache in the tornado process if possible.
+
+    '''
+
+    cpdict = _read_checkplot_picklefile(cpfpath)
+
+    # break out the initial info
+    objectid = cpdict['objectid']
+    objectinfo = cpdict['objectinfo']
+    varinfo = cpdict['varinfo']
+
+    if 'comments' in cpdict:
+        objectcomments = cpdict['comments']
+    else:
+        objectcomments = None
+
+    # these are base64 encoded PNGs. we decode them once here and serve them
+    # as images from their own URLs instead of sending them in the JSON
+    cpplots = {
+        'finderchart':_b64_to_png(cpdict['finderchart']),
+        'magseries':_b64_to_png(cpdict['magseries']['plot']),
+    }
+    cpstatus = cpdict['status']
+
+    # FIXME: add in other stuff required by the frontend
+    # - signals
+
+
+    # FIXME: the frontend should load these other things as well
+    # into the various elems on the period-search-tools and
+    # variability-tools tabs
+
+    # this is the initial dict
+    cpresult = {
+        'objectid':objectid,
+        'objectinfo':objectinfo,
+        'objectcomments':objectcomments,
+        'varinfo':varinfo,
+        'finderchart_url':'%s/finderchart' % ploturl,
+        'magseries_url':'%s/magseries' % ploturl,
+        # fallback in case objectinfo doesn't have ndet
+        'magseries_ndet':cpdict['magseries']['times'].size,
+        'cpstatus':cpstatus,
+    }
+
+    # now get the other stuff
+    for key in ('pdm','aov','bls','gls','sls'):
+
+        # we return only the first three phased LCs per periodogram
+        if key in cpdict:
+
+            # get the periodogram for this method
+            cpplots['%s-periodogram' % key] = _b64_to_png(
+                cpdict[key]['periodogram']
+            )
+
+            # get the phased LC with best period
+            cpplots['%s-phasedlc0' % key] = _b64_to_png(
+                cpdict[key][0]['plot']
+            )
+
+            # get the associated fitinfo for this period if it
+            # exists
+            if ('lcfit' in cpdict[key][0] and
+                isinstance(cpdict[key][0]['lcfit'], dict)):
+                phasedlc0fit = {
+                    'method':(
+                        cpdict[key][0]['lcfit']['fittype']
+                        ),
+                    'redchisq':(
+                        cpdict[key][0]['lcfit']['fitredchisq']
+                        ),
+                    'chisq':(
+                        cpdict[key][0]['lcfit']['fitchisq']
+                        ),
+                    'params':(
+                        cpdict[key][0][
+                            'lcfit'
+                        ]['fitinfo']['finalparams'] if
+                        'finalparams' in
+                        cpdict[key][0]['lcfit']['fitinfo'] else None
+                        )
+                    }
+            else:
+                phasedlc0fit = None
+
+
+            # get the phased LC with 2nd best period
+            cpplots['%s-phasedlc1' % key] = _b64_to_png(
+                cpdict[key][1]['plot']
+            )
+
+            # get the associated fitinfo for this period if it
+            # exists
+            if ('lcfit' in cpdict[key][1] and
+                isinstance(cpdict[key][1]['lcfit'], dict)):
+                phasedlc1fit = {
+                    'method':(
+                        cpdict[key][1]['lcfit']['fittype']
+                        ),
+                    'redchisq':(
+                        cpdict[key][1]['lcfit']['fitredchisq']
+                        ),
+                    'chisq':(
+                        cpdict[key][1]['lcfit']['fitchisq']
+                        ),
+                    'params':(
+                        cpdict[key][1][
+                            'lcfit'
+                        ]['fitinfo']['finalparams'] if
+                        'finalparams' in
+                        cpdict[key][1]['lcfit']['fitinfo'] else None
+                        )
+                    }
+            else:
+                phasedlc1fit = None
+
+
+            # get the phased LC with 3rd best period
+            cpplots['%s-phasedlc2' % key] = _b64_to_png(
+                cpdict[key][2]['plot']
+            )
+
+            # get the associated fitinfo for this period if it
+            # exists
+            if ('lcfit' in cpdict[key][2] and
+                isinstance(cpdict[key][2]['lcfit'], dict)):
+                phasedlc2fit = {
+                    'method':(
+                        cpdict[key][2]['lcfit']['fittype']
+                        ),
+                    'redchisq':(
+                        cpdict[key][2]['lcfit']['fitredchisq']
+                        ),
+                    'chisq':(
+                        cpdict[key][2]['lcfit']['fitchisq']
+                        ),
+                    'params':(
+                        cpdict[key][2][
+                            'lcfit'
+                        ]['fitinfo']['finalparams'] if
+                        'finalparams' in
+                        cpdict[key][2]['lcfit']['fitinfo'] else None
+                        )
+                    }
+            else:
+                phasedlc2fit = None
+
+            cpresult[key] = {
+                'nbestperiods':cpdict[key]['nbestperiods'],
+                'periodogram_url':'%s/%s-periodogram' % (ploturl, key),
+                'bestperiod':cpdict[key]['bestperiod'],
+                'phasedlc0':{
+                    'plot_url':'%s/%s-phasedlc0' % (ploturl, key),
+                    'period':float(cpdict[key][0]['period']),
+                    'epoch':float(cpdict[key][0]['epoch']),
+                    'lcfit':phasedlc0fit,
+                },
+                'phasedlc1':{
+                    'plot_url':'%s/%s-phasedlc1' % (ploturl, key),
+                    'period':float(cpdict[key][1]['period']),
+                    'epoch':float(cpdict[key][1]['epoch']),
+                    'lcfit':phasedlc1fit,
+                },
+                'phasedlc2':{
+                    'plot_url':'%s/%s-phasedlc2' % (ploturl, key),
+                    'period':float(cpdict[key][2]['period']),
+                    'epoch':float(cpdict[key][2]['epoch']),
+                    'lcfit':phasedlc2fit,
+                },
+            }
+
+    return cpresult, cpplots
+
+
+
+# this holds the recently loaded checkplots in the tornado process, so repeat
+# loads don't depend on which executor worker gets them. this is keyed by the
+# checkplot path and the values are (statkey, (cpresult, cpplots)) tuples,
+# where statkey is from _checkplot_statkey below. the oldest checkplots are
+# dropped first.
+_CHECKPLOT_CACHE = OrderedDict()
+_CHECKPLOT_CACHE_MAXSIZE = 32
+
+# this holds the executor futures for the checkplots being loaded right now, so
+# requests for the same checkplot wait for a single load
+_CHECKPLOT_LOADING = {}
+
+def _checkplot_statkey(cpfpath):
+    '''
+    This returns the (mtime, size) of a checkplot pickle, used to figure out if
+    it changed since it was cached.
+
+    st_mtime_ns is used if available, since st_mtime may only have a resolution
+    of one second on some filesystems.
+
+    '''
+
+    cpstat = os.stat(cpfpath)
+    return (getattr(cpstat, 'st_mtime_ns', cpstat.st_mtime), cpstat.st_size)
+
+
+
+@gen.coroutine
+def _get_checkplot(executor, cpfpath, ploturl):
+    '''
+    This returns the (cpresult, cpplots) from _load_checkplot for a checkplot,
+    using the cache if the checkplot hasn't changed since it was loaded.
+
+    '''
+
+    statkey = _checkplot_statkey(cpfpath)
+
+    # pop and put back cache hits so they're the last to be dropped
+    cached = _CHECKPLOT_CACHE.pop(cpfpath, None)
+
+    if cached is not None and cached[0] == statkey:
+        _CHECKPLOT_CACHE[cpfpath] = cached
+        raise gen.Return(cached[1])
+
+    loadkey = (cpfpath, statkey)
+
+    if loadkey not in _CHECKPLOT_LOADING:
+        _CHECKPLOT_LOADING[loadkey] = executor.submit(_load_checkplot,
+                                                      cpfpath,
+                                                      ploturl)
+
+    try:
+        loaded = yield _CHECKPLOT_LOADING[loadkey]
+    finally:
+        _CHECKPLOT_LOADING.pop(loadkey, None)
+
+    _CHECKPLOT_CACHE[cpfpath] = (statkey, loaded)
+    while len(_CHECKPLOT_CACHE) > _CHECKPLOT_CACHE_MAXSIZE:
+        _CHECKPLOT_CACHE.popitem(last=False)
+
+    raise gen.Return(loaded)
+
+
+
+############################
+## CHECKPLOT LIST HELPERS ##
+############################
+
+def _checkplot_from_b64(b64cpfname, cplist):
+    '''This decodes a base64 encoded checkplot name from the frontend.
+
+    Returns the checkplot name if it's in the cplist['checkplots_set'] set up
+    by the checkplotserver at startup, or None if it isn't or can't be decoded.
+    Since only names in the checkplot list get through, this also stops
+    requests from getting at any other files on the server.
+
+    '''
+
+    try:
+        cpfname = base64.b64decode(b64cpfname).decode('utf-8')
+    except (TypeError, ValueError):
+        return None
+
+    if cpfname in cplist['checkplots_set']:
+        return cpfname
+    else:
+        return None
+
+
+
+def _cplist_json_dict(cplist):
+    '''
+    This returns the checkplot list dict without the items added by the
+    checkplotserver at startup, for writing to JSON.
+
+    '''
+
+    return {key:cplist[key] for key in cplist if key != 'checkplots_set'}
+
+
+
 #####################
 ## HANDLER CLASSES ##
 #####################
@@ -279,6 +632,12 @@ class IndexHandler(tornado.web.RequestHandler):
 
     '''
 
+    # the checkplot list doesn't change while the server is running, so the
+    # basenames for the index page are only worked out once for each
+    # checkplot list file. tornado makes a new handler for every request, so
+    # these are kept at the class level.
+    project_checkplotbasenames = {}
+
     def initialize(self, currentdir, assetpath, cplist,
                    cplistfile, executor, readonly):
         '''
@@ -293,6 +652,11 @@ class IndexHandler(tornado.web.RequestHandler):
         self.executor = executor
         self.readonly = readonly
 
+        if cplistfile not in IndexHandler.project_checkplotbasenames:
+            IndexHandler.project_checkplotbasenames[cplistfile] = [
+                os.path.basename(x) for x in cplist['checkplots']
+            ]
+
 
 
     def get(self):
@@ -309,8 +673,9 @@ class IndexHandler(tornado.web.RequestHandler):
 
         # generate the project's list of checkplots
         project_checkplots = self.currentproject['checkplots']
-        project_checkplotbasenames = [os.path.basename(x)
-                                      for x in project_checkplots]
+        project_checkplotbasenames = (
+            IndexHandler.project_checkplotbasenames[self.cplistfile]
+        )
         project_checkplotindices = range(len(project_checkplots))
 
         # get the sortkey and order
@@ -369,13 +734,12 @@ class CheckplotHandler(tornado.web.RequestHandler):
 
         if checkplotfname:
 
-            # do the usual safing
-            self.checkplotfname = xhtml_escape(
-                base64.b64decode(checkplotfname)
-            )
+            # this is only used as a path, so it doesn't need escaping; only
+            # names in the current project get through
+            self.checkplotfname = _checkplot_from_b64(checkplotfname,
+                                                      self.currentproject)
 
-            # see if this plot is in the current project
-            if self.checkplotfname in self.currentproject['checkplots']:
+            if self.checkplotfname is not None:
 
                 # make sure this file exists
                 cpfpath = os.path.join(
@@ -396,183 +760,38 @@ class CheckplotHandler(tornado.web.RequestHandler):
                     self.write(resultdict)
                     raise tornado.web.Finish()
 
-                # this is the async call to the executor
-                cpdict = yield self.executor.submit(
-                    _read_checkplot_picklefile, cpfpath
-                )
+                # the plots in the checkplot are served separately by
+                # CheckplotPlotHandler at these URLs
+                ploturl = '/plot/%s' % checkplotfname
+
+                # this is the async call to the executor. the assembled
+                # checkplot info is cached in this process by the checkplot's
+                # mtime and size, so repeated loads of an unchanged checkplot
+                # don't have to read, unpickle, and pick apart the pickle again
+                cpresult, cpplots = yield _get_checkplot(self.executor,
+                                                         cpfpath,
+                                                         ploturl)
 
                 #####################################
                 ## continue after we're good to go ##
                 #####################################
 
-                # break out the initial info
-                objectid = cpdict['objectid']
-                objectinfo = cpdict['objectinfo']
-                varinfo = cpdict['varinfo']
-
-                if 'comments' in cpdict:
-                    objectcomments = cpdict['comments']
-                else:
-                    objectcomments = None
-
-                # these are base64 which can be provided directly to JS to
-                # generate images (neat!)
-                finderchart = cpdict['finderchart']
-                magseries = cpdict['magseries']['plot']
-                cpstatus = cpdict['status']
-
-                # FIXME: add in other stuff required by the frontend
-                # - signals
-
-
-                # FIXME: the frontend should load these other things as well
-                # into the various elems on the period-search-tools and
-                # variability-tools tabs
-
-                # this is the initial dict
                 resultdict = {
                     'status':'ok',
                     'message':'found checkplot %s' % self.checkplotfname,
                     'readonly':self.readonly,
-                    'result':{
-                        'objectid':objectid,
-                        'objectinfo':objectinfo,
-                        'objectcomments':objectcomments,
-                        'varinfo':varinfo,
-                        'finderchart':finderchart,
-                        'magseries':magseries,
-                        # fallback in case objectinfo doesn't have ndet
-                        'magseries_ndet':cpdict['magseries']['times'].size,
-                        'cpstatus':cpstatus,
-                    }
+                    'result':cpresult,
                 }
 
-                # now get the other stuff
-                for key in ('pdm','aov','bls','gls','sls'):
-
-                    # we return only the first three phased LCs per periodogram
-                    if key in cpdict:
-
-                        # get the periodogram for this method
-                        periodogram = cpdict[key]['periodogram']
-
-                        # get the phased LC with best period
-                        phasedlc0plot = cpdict[key][0]['plot']
-
-                        # get the associated fitinfo for this period if it
-                        # exists
-                        if ('lcfit' in cpdict[key][0] and
-                            isinstance(cpdict[key][0]['lcfit'], dict)):
-                            phasedlc0fit = {
-                                'method':(
-                                    cpdict[key][0]['lcfit']['fittype']
-                                    ),
-                                'redchisq':(
-                                    cpdict[key][0]['lcfit']['fitredchisq']
-                                    ),
-                                'chisq':(
-                                    cpdict[key][0]['lcfit']['fitchisq']
-                                    ),
-                                'params':(
-                                    cpdict[key][0][
-                                        'lcfit'
-                                    ]['fitinfo']['finalparams'] if
-                                    'finalparams' in
-                                    cpdict[key][0]['lcfit']['fitinfo'] else None
-                                    )
-                                }
-                        else:
-                            phasedlc0fit = None
-
-
-                        # get the phased LC with 2nd best period
-                        phasedlc1plot = cpdict[key][1]['plot']
-
-                        # get the associated fitinfo for this period if it
-                        # exists
-                        if ('lcfit' in cpdict[key][1] and
-                            isinstance(cpdict[key][1]['lcfit'], dict)):
-                            phasedlc1fit = {
-                                'method':(
-                                    cpdict[key][1]['lcfit']['fittype']
-                                    ),
-                                'redchisq':(
-                                    cpdict[key][1]['lcfit']['fitredchisq']
-                                    ),
-                                'chisq':(
-                                    cpdict[key][1]['lcfit']['fitchisq']
-                                    ),
-                                'params':(
-                                    cpdict[key][1][
-                                        'lcfit'
-                                    ]['fitinfo']['finalparams'] if
-                                    'finalparams' in
-                                    cpdict[key][1]['lcfit']['fitinfo'] else None
-                                    )
-                                }
-                        else:
-                            phasedlc1fit = None
-
-
-                        # get the phased LC with 3rd best period
-                        phasedlc2plot = cpdict[key][2]['plot']
-
-                        # get the associated fitinfo for this period if it
-                        # exists
-                        if ('lcfit' in cpdict[key][2] and
-                            isinstance(cpdict[key][2]['lcfit'], dict)):
-                            phasedlc2fit = {
-                                'method':(
-                                    cpdict[key][2]['lcfit']['fittype']
-                                    ),
-                                'redchisq':(
-                                    cpdict[key][2]['lcfit']['fitredchisq']
-                                    ),
-                                'chisq':(
-                                    cpdict[key][2]['lcfit']['fitchisq']
-                                    ),
-                                'params':(
-                                    cpdict[key][2][
-                                        'lcfit'
-                                    ]['fitinfo']['finalparams'] if
-                                    'finalparams' in
-                                    cpdict[key][2]['lcfit']['fitinfo'] else None
-                                    )
-                                }
-                        else:
-                            phasedlc2fit = None
-
-                        resultdict['result'][key] = {
-                            'nbestperiods':cpdict[key]['nbestperiods'],
-                            'periodogram':periodogram,
-                            'bestperiod':cpdict[key]['bestperiod'],
-                            'phasedlc0':{
-                                'plot':phasedlc0plot,
-                                'period':float(cpdict[key][0]['period']),
-                                'epoch':float(cpdict[key][0]['epoch']),
-                                'lcfit':phasedlc0fit,
-                            },
-                            'phasedlc1':{
-                                'plot':phasedlc1plot,
-                                'period':float(cpdict[key][1]['period']),
-                                'epoch':float(cpdict[key][1]['epoch']),
-                                'lcfit':phasedlc1fit,
-                            },
-                            'phasedlc2':{
-                                'plot':phasedlc2plot,
-                                'period':float(cpdict[key][2]['period']),
-                                'epoch':float(cpdict[key][2]['epoch']),
-                                'lcfit':phasedlc2fit,
-                            },
-                        }
-
                 # return this via JSON
-                self.write(resultdict)
+                self.set_header('Content-Type',
+                                'application/json; charset=UTF-8')
+                self.write(_frontend_json(resultdict))
                 self.finish()
 
             else:
 
-                LOGGER.error('could not find %s' % self.checkplotfname)
+                LOGGER.error('could not find checkplot %s' % checkplotfname)
 
                 resultdict = {'status':'error',
                               'message':"This checkplot doesn't exist.",
@@ -634,7 +853,7 @@ class CheckplotHandler(tornado.web.RequestHandler):
                 self.write(resultdict)
                 raise tornado.web.Finish()
 
-            cpcontents = json.loads(cpcontents)
+            cpcontents = _frontend_json_loads(cpcontents)
 
             # the only keys in cpdict that can updated from the UI are from
             # varinfo, objectinfo (objecttags) and comments
@@ -724,6 +943,74 @@ class CheckplotHandler(tornado.web.RequestHandler):
 
 
 
+class CheckplotPlotHandler(tornado.web.RequestHandler):
+    '''This handles serving the plots in checkplots as PNG images.
+
+    The URLs for these are sent to the frontend by CheckplotHandler.get, so the
+    plots don't have to be sent as base64 in its JSON.
+
+    '''
+
+    def initialize(self, currentdir, assetpath, cplist,
+                   cplistfile, executor, readonly):
+        '''
+        handles initial setup.
+
+        '''
+
+        self.currentdir = currentdir
+        self.assetpath = assetpath
+        self.currentproject = cplist
+        self.cplistfile = cplistfile
+        self.executor = executor
+        self.readonly = readonly
+
+
+    @gen.coroutine
+    def get(self, checkplotfname, plotkey):
+        '''This handles GET requests.
+
+        plotkey is one of: finderchart, magseries, {lspmethod}-periodogram,
+        {lspmethod}-phasedlc{0,1,2}.
+
+        '''
+
+        self.checkplotfname = _checkplot_from_b64(checkplotfname,
+                                                  self.currentproject)
+
+        if self.checkplotfname is None:
+            raise tornado.web.HTTPError(404)
+
+        cpfpath = os.path.join(
+            os.path.abspath(os.path.dirname(self.cplistfile)),
+            self.checkplotfname
+        )
+
+        if not os.path.exists(cpfpath):
+            LOGGER.error("couldn't find checkplot %s" % cpfpath)
+            raise tornado.web.HTTPError(404)
+
+        # the plots come from the checkplot cache in this process, which was
+        # filled when CheckplotHandler.get sent their URLs. the executor is
+        # only used if the checkplot has changed or dropped out of the cache
+        # since then, and then only once for all of its plots
+        cpresult, cpplots = yield _get_checkplot(self.executor,
+                                                 cpfpath,
+                                                 '/plot/%s' % checkplotfname)
+        plotpng = cpplots.get(plotkey)
+
+        if plotpng is None:
+            raise tornado.web.HTTPError(404)
+
+        # the plots at these URLs change if the checkplot is updated, so make
+        # browsers check the ETag that tornado adds instead of caching them
+        self.set_header('Content-Type', 'image/png')
+        self.set_header('Cache-Control', 'no-cache')
+        self.write(plotpng)
+        self.finish()
+
+
+
 class CheckplotListHandler(tornado.web.RequestHandler):
     '''This handles loading and saving the checkplot-filelist.json file.
 
@@ -761,7 +1048,7 @@ class CheckplotListHandler(tornado.web.RequestHandler):
             self.currentproject['reviewed'] = {}
 
         # just returns the current project as JSON
-        self.write(self.currentproject)
+        self.write(_cplist_json_dict(self.currentproject))
 
 
 
@@ -806,7 +1093,7 @@ class CheckplotListHandler(tornado.web.RequestHandler):
 
         # otherwise, update the checkplot list JSON
         objectid = xhtml_escape(objectid)
-        changes = json.loads(changes)
+        changes = _frontend_json_loads(changes)
 
         # update the dictionary
         if 'reviewed' not in self.currentproject:
@@ -816,7 +1103,7 @@ class CheckplotListHandler(tornado.web.RequestHandler):
 
         # update the JSON file
         with open(self.cplistfile,'w') as outfd:
-            json.dump(self.currentproject, outfd)
+            json.dump(_cplist_json_dict(self.currentproject), outfd)
 
         # return status
         msg = ("wrote all changes to the checkplot filelist "
@@ -936,7 +1223,7 @@ class LCToolHandler(tornado.web.RequestHandler):
             self.cpfile = xhtml_escape(base64.b64decode(cpfile))
 
             # see if this plot is in the current project
-            if self.cpfile in self.currentproject['checkplots']:
+            if self.cpfile in self.currentproject['checkplots_set']:
 
                 # make sure this file exists
                 cpfpath = os.path.join(
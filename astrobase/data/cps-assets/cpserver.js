@@ -404,8 +404,7 @@ var cpv = {
             }
 
             // update the finder chart
-            cputils.b64_to_image(cpv.currcp.finderchart,
-                                 '#finderchart');
+            $('#finderchart').attr('src', cpv.currcp.finderchart_url);
 
 
             var hatstations = cpv.currcp.objectinfo.stations;
@@ -469,8 +468,7 @@ var cpv = {
             $('#colors').html(colors);
 
             // update the magseries plot
-            cputils.b64_to_image(cpv.currcp.magseries,
-                                '#magseriesplot');
+            $('#magseriesplot').attr('src', cpv.currcp.magseries_url);
 
             // update the varinfo
             if (cpv.currcp.varinfo.objectisvar == 1) {
@@ -539,7 +537,7 @@ var cpv = {
                 if (lspmethod in cpv.currcp) {
 
                     var nbestperiods = cpv.currcp[lspmethod].nbestperiods;
-                    var periodogram = cpv.currcp[lspmethod].periodogram;
+                    var periodogram = cpv.currcp[lspmethod].periodogram_url;
 
                     // start putting together the container for this method
                     var mcontainer_coltop =
@@ -550,8 +548,8 @@ var cpv = {
                     var periodogram_row =
                         '<div class="row periodogram-container">' +
                         '<div class="col-sm-12">' +
-                        '<img src="data:image/png;base64,' +
-                        cpv.currcp[lspmethod].periodogram + '" ' +
+                        '<img src="' +
+                        cpv.currcp[lspmethod].periodogram_url + '" ' +
                         'class="img-fluid" id="periodogram-' +
                         lspmethod + '">' + '</div></div>';
 
@@ -582,8 +580,9 @@ var cpv = {
                                 '<div class="row py-1 phasedlc-container-row" ' +
                                 'data-periodind="' + periodind + '">' +
                                 '<div class="col-sm-12">' +
-                                '<img src="data:image/png;base64,' +
-                                cpv.currcp[lspmethod][periodind].plot + '"' +
+                                '<img src="' +
+                                cpv.currcp[lspmethod][periodind].plot_url +
+                                '"' +
                                 'class="img-fluid" id="plot-' +
                                 periodind + '">' + '</div></div></a>';
 
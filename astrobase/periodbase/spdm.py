@@ -21,15 +21,23 @@ from numpy import nan as npnan, sum as npsum, abs as npabs, \
     roll as nproll, isfinite as npisfinite, std as npstd, \
     sign as npsign, sqrt as npsqrt, median as npmedian, \
     array as nparray, percentile as nppercentile, \
-    polyfit as nppolyfit, var as npvar, max as npmax, min as npmin, \
+    polyfit as nppolyfit, max as npmax, min as npmin, \
     log10 as nplog10, arange as nparange, pi as MPI, floor as npfloor, \
     argsort as npargsort, cos as npcos, sin as npsin, tan as nptan, \
     where as npwhere, linspace as nplinspace, \
     zeros_like as npzeros_like, full_like as npfull_like, \
     arctan as nparctan, nanargmax as npnanargmax, nanargmin as npnanargmin, \
     empty as npempty, ceil as npceil, mean as npmean, \
-    digitize as npdigitize, unique as npunique, \
-    argmax as npargmax, argmin as npargmin
+    argmax as npargmax, argmin as npargmin, bincount as npbincount, \
+    minimum as npminimum
+
+# experimental numba speedup stuff
+try:
+    from numba import njit, prange, get_num_threads, set_num_threads
+    from numba import config as numbaconfig
+    HAVENUMBA = True
+except:
+    HAVENUMBA = False
 
 
 #############
@@ -82,7 +90,7 @@ def LOGEXCEPTION(message):
 ## LOCAL IMPORTS ##
 ###################
 
-from ..lcmath import phase_magseries, sigclip_magseries, time_bin_magseries, \
+from ..lcmath import sigclip_magseries, time_bin_magseries, \
     phase_bin_magseries
 
 from . import get_frequency_grid
@@ -94,67 +102,219 @@ from . import get_frequency_grid
 
 NCPUS = cpu_count()
 
+# this holds the autofreq frequency grids already calculated by
+# stellingwerf_pdm, so light curves sharing the same time baseline (e.g. many
+# objects from the same field) don't have to recalculate it
+_freq_grid_cache = {}
+_FREQ_GRID_CACHE_MAXSIZE = 128
+
 
 ####################################################################
 ## PHASE DISPERSION MINIMIZATION (Stellingwerf+ 1978, 2011, 2013) ##
 ####################################################################
 
-def stellingwerf_pdm_theta(times, mags, errs, frequency,
-                           binsize=0.05, minbin=9):
+def stellingwerf_pdm_theta(dt, mags, frequency, nbins, minbin):
     '''
     This calculates the Stellingwerf PDM theta value at a test frequency.
 
+    dt is the array of times relative to the first time (i.e. times -
+    times[0]), which is used as the epoch for phasing. dt and mags should be
+    contiguous float ndarrays and the mags should all be finite. The phase
+    range 0.0 to 1.0 is split into nbins equal bins, and only bins with more
+    than minbin points in them are used.
+
     '''
 
-    period = 1.0/frequency
-    fold_time = times[0]
+    # the bin statistics don't depend on the order of the points, so there's
+    # no need to sort these by phase. the phases are worked out in place to
+    # avoid making more temporary arrays than needed. we don't use np.modf
+    # here since dt can be negative if the times aren't sorted
+    phases = dt*frequency
+    phases -= npfloor(phases)
+
+    # the bins are uniform in phase, so the bin index for each point is just
+    # the integer part of phase*nbins
+    phases *= nbins
+    binnedphaseinds = npminimum(phases.astype(np.intp), nbins - 1)
+
+    # get the per-bin number of detections, sums, and sums of squares in one go
+    # instead of looping over each bin. the mags are centered first so the
+    # sum-of-squares variance below doesn't lose precision
+    cmags = mags - npmean(mags)
+    cmagsqs = cmags*cmags
+
+    binndets = npbincount(binnedphaseinds, minlength=nbins)
+    binsums = npbincount(binnedphaseinds, weights=cmags, minlength=nbins)
+    binsumsqs = npbincount(binnedphaseinds, weights=cmagsqs, minlength=nbins)
+
+    # only use the bins that have more than minbin points in them
+    goodbininds = binndets > minbin
+    goodbins = npsum(goodbininds)
+    binndets = binndets[goodbininds]
+    binsums = binsums[goodbininds]
+
+    # sum of (binndets - 1) x (ddof=1 variance) over the good bins
+    theta_top = (
+        npsum(binsumsqs[goodbininds] - binsums*binsums/binndets) /
+        (npsum(binndets) - goodbins)
+    )
+
+    # this is the ddof=1 variance of all the mags
+    theta_bot = npsum(cmagsqs, dtype=np.float64)/(cmagsqs.size - 1)
+    theta = theta_top/theta_bot
 
-    phased = phase_magseries(times,
-                             mags,
-                             period,
-                             fold_time,
-                             wrap=False,
-                             sort=True)
+    return theta
 
-    phases = phased['phase']
-    pmags = phased['mags']
-    bins = np.arange(0.0, 1.0, binsize)
-    nbins = bins.size
 
-    binnedphaseinds = npdigitize(phases, bins)
 
-    binvariances = []
-    binndets = []
-    goodbins = 0
+if HAVENUMBA:
 
-    for x in npunique(binnedphaseinds):
+    # the number of frequencies each numba thread works through at a time
+    _PDM_FREQ_BLOCKSIZE = 256
 
-        thisbin_inds = binnedphaseinds == x
-        thisbin_phases = phases[thisbin_inds]
-        thisbin_mags = pmags[thisbin_inds]
+    @njit(cache=True, parallel=True, fastmath=True)
+    def _pdm_theta_grid(dt, mags, freqs, nbins, minbin):
+        '''
+        This calculates the Stellingwerf PDM theta values at all the test
+        frequencies in freqs, running over these in parallel threads.
 
-        if thisbin_mags.size > minbin:
-            thisbin_variance = npvar(thisbin_mags,ddof=1)
-            binvariances.append(thisbin_variance)
-            binndets.append(thisbin_mags.size)
-            goodbins = goodbins + 1
+        This does the same thing as stellingwerf_pdm_theta. dt is the array of
+        times relative to the first time.
 
-    # now calculate theta
-    binvariances = nparray(binvariances)
-    binndets = nparray(binndets)
+        '''
 
-    theta_top = npsum(binvariances*(binndets - 1)) / (npsum(binndets) -
-                                                      goodbins)
-    theta_bot = npvar(pmags,ddof=1)
-    theta = theta_top/theta_bot
+        ndets = dt.size
+        lsp = np.empty(freqs.size)
 
-    return theta
+        # center the mags and get the total variance. the centered mags keep
+        # the dtype of the input mags, but all the sums are done in float64
+        meanmag = 0.0
+        for j in range(ndets):
+            meanmag += mags[j]
+        meanmag = meanmag/ndets
+
+        cmags = np.empty(ndets, dtype=mags.dtype)
+        totsumsq = 0.0
+        for j in range(ndets):
+            cmags[j] = mags[j] - meanmag
+            totsumsq += np.float64(cmags[j])*cmags[j]
+
+        theta_bot = totsumsq/(ndets - 1)
+
+        # the frequencies are handed to the threads in blocks, and each block
+        # reuses one set of bin accumulators instead of allocating new ones
+        # for every frequency
+        nblocks = (freqs.size + _PDM_FREQ_BLOCKSIZE - 1)//_PDM_FREQ_BLOCKSIZE
+
+        for b in prange(nblocks):
+
+            binndets = np.empty(nbins, dtype=np.int64)
+            binsums = np.empty(nbins)
+            binsumsqs = np.empty(nbins)
+
+            blockend = min((b + 1)*_PDM_FREQ_BLOCKSIZE, freqs.size)
+
+            for i in range(b*_PDM_FREQ_BLOCKSIZE, blockend):
+
+                freq = freqs[i]
+
+                binndets[:] = 0
+                binsums[:] = 0.0
+                binsumsqs[:] = 0.0
+
+                for j in range(ndets):
+
+                    phase = dt[j]*freq
+                    phase = phase - np.floor(phase)
+
+                    binind = int(phase*nbins)
+                    if binind > nbins - 1:
+                        binind = nbins - 1
+
+                    binndets[binind] += 1
+                    binsums[binind] += cmags[j]
+                    binsumsqs[binind] += cmags[j]*cmags[j]
+
+                # only use the bins that have more than minbin points in them
+                theta_top = 0.0
+                goodndets = 0
+                goodbins = 0
+
+                for k in range(nbins):
+                    if binndets[k] > minbin:
+                        theta_top += (binsumsqs[k] -
+                                      binsums[k]*binsums[k]/binndets[k])
+                        goodndets += binndets[k]
+                        goodbins += 1
+
+                if goodbins > 0 and theta_bot > 0.0:
+                    lsp[i] = (theta_top/(goodndets - goodbins))/theta_bot
+                else:
+                    lsp[i] = np.nan
+
+        return lsp
+
+
+
+    @njit(cache=True)
+    def _filter_sigclip(times, mags, errs, sigclip):
+        '''
+        This selects the finite times, mags, and errs and applies a symmetric
+        sigma-clip to them based on the median and MAD of the finite mags.
+
+        This does the same thing as lcmath.sigclip_magseries with a float
+        sigclip and iterative=False, but walks over the arrays directly
+        instead of making a new array for each mask.
+
+        '''
+
+        ndets = times.size
+
+        # first pass: collect the finite mags to get their median and MAD
+        finitemags = np.empty(ndets)
+        nfinite = 0
+
+        for i in range(ndets):
+            if (np.isfinite(times[i]) and
+                np.isfinite(mags[i]) and
+                np.isfinite(errs[i])):
+                finitemags[nfinite] = mags[i]
+                nfinite += 1
+
+        stimes = np.empty(nfinite)
+        smags = np.empty(nfinite)
+        serrs = np.empty(nfinite)
+
+        if nfinite == 0:
+            return stimes, smags, serrs
+
+        finitemags = finitemags[:nfinite]
+        median_mag = np.median(finitemags)
+
+        for i in range(nfinite):
+            finitemags[i] = abs(finitemags[i] - median_mag)
+        stddev_mag = np.median(finitemags) * 1.483
+
+        # second pass: write out the finite points that survive the sigclip
+        nclipped = 0
+
+        for i in range(ndets):
+            if (np.isfinite(times[i]) and
+                np.isfinite(mags[i]) and
+                np.isfinite(errs[i]) and
+                abs(mags[i] - median_mag) < sigclip*stddev_mag):
+                stimes[nclipped] = times[i]
+                smags[nclipped] = mags[i]
+                serrs[nclipped] = errs[i]
+                nclipped += 1
+
+        return stimes[:nclipped], smags[:nclipped], serrs[:nclipped]
 
 
 
 def stellingwerf_pdm_worker(task):
     '''
-    This is a parallel worker for the function below.
+    This is a parallel worker for a single test frequency.
 
     task[0] = times
     task[1] = mags
@@ -163,23 +323,78 @@ def stellingwerf_pdm_worker(task):
     task[4] = binsize
     task[5] = minbin
 
+    errs isn't used. stellingwerf_pdm doesn't use this worker anymore, but it's
+    kept for code that maps over per-frequency tasks itself.
+
     '''
 
     times, mags, errs, frequency, binsize, minbin = task
 
     try:
 
-        theta = stellingwerf_pdm_theta(times, mags, errs, frequency,
-                                       binsize=binsize, minbin=minbin)
+        dt = np.ascontiguousarray(times - times[0], dtype=np.float64)
+        theta = stellingwerf_pdm_theta(dt,
+                                       np.ascontiguousarray(mags),
+                                       frequency,
+                                       int(npceil(1.0/binsize)),
+                                       minbin)
 
         return theta
 
-    except Exception as e:
+    except Exception:
 
         return npnan
 
 
 
+# these hold the light curve in each worker process so it doesn't have to be
+# sent along with every frequency task. they're set by _pdm_init below.
+_PDM_DT = None
+_PDM_MAGS = None
+_PDM_NBINS = None
+_PDM_MINBIN = None
+
+def _pdm_init(dt, mags, nbins, minbin):
+    '''
+    This is the initializer for the worker pool used in the function below.
+
+    '''
+
+    global _PDM_DT, _PDM_MAGS, _PDM_NBINS, _PDM_MINBIN
+
+    _PDM_DT = dt
+    _PDM_MAGS = mags
+    _PDM_NBINS = nbins
+    _PDM_MINBIN = minbin
+
+
+
+def _pdm_chunk_worker(frequencies):
+    '''
+    This is a parallel worker for the function below that gets a chunk of the
+    frequency grid and returns the thetas for all of them. The rest of the
+    inputs come from the worker's globals.
+
+    '''
+
+    thetas = npempty(frequencies.size)
+
+    for ind, frequency in enumerate(frequencies):
+
+        try:
+
+            thetas[ind] = stellingwerf_pdm_theta(_PDM_DT, _PDM_MAGS,
+                                                 frequency,
+                                                 _PDM_NBINS, _PDM_MINBIN)
+
+        except Exception:
+
+            thetas[ind] = npnan
+
+    return thetas
+
+
+
 def stellingwerf_pdm(times,
                      mags,
                      errs,
@@ -200,12 +415,26 @@ def stellingwerf_pdm(times,
 
     '''
 
-    # get rid of nans first and sigclip
-    stimes, smags, serrs = sigclip_magseries(times,
-                                             mags,
-                                             errs,
-                                             magsarefluxes=magsarefluxes,
-                                             sigclip=sigclip)
+    # get rid of nans first and sigclip. if we have numba, do the usual
+    # symmetric sigclip in a single kernel instead. sigclip = 0.0 means no
+    # sigclip to sigclip_magseries, so that goes through it as well
+    if (HAVENUMBA and sigclip and isinstance(sigclip, float) and
+        errs is not None):
+
+        stimes, smags, serrs = _filter_sigclip(
+            np.ascontiguousarray(times, dtype=np.float64),
+            np.ascontiguousarray(mags, dtype=np.float64),
+            np.ascontiguousarray(errs, dtype=np.float64),
+            sigclip
+        )
+
+    else:
+
+        stimes, smags, serrs = sigclip_magseries(times,
+                                                 mags,
+                                                 errs,
+                                                 magsarefluxes=magsarefluxes,
+                                                 sigclip=sigclip)
 
     # make sure there are enough points to calculate a spectrum
     if len(stimes) > 9 and len(smags) > 9 and len(serrs) > 9:
@@ -232,10 +461,26 @@ def stellingwerf_pdm(times,
                     (frequencies.size, 1.0/endf, 1.0/startf)
                 )
         else:
-            # this gets an automatic grid of frequencies to use
-            frequencies = get_frequency_grid(stimes,
-                                             minfreq=startf,
-                                             maxfreq=endf)
+            # this gets an automatic grid of frequencies to use. the grid only
+            # depends on the time baseline, the number of points, and the
+            # frequency limits, so reuse it if we've seen these before
+            freqgridkey = (stimes.size,
+                           float(stimes.min()),
+                           float(stimes.max()),
+                           startf,
+                           endf)
+            frequencies = _freq_grid_cache.get(freqgridkey)
+
+            if frequencies is None:
+
+                frequencies = get_frequency_grid(stimes,
+                                                 minfreq=startf,
+                                                 maxfreq=endf)
+
+                if len(_freq_grid_cache) >= _FREQ_GRID_CACHE_MAXSIZE:
+                    _freq_grid_cache.clear()
+                _freq_grid_cache[freqgridkey] = frequencies
+
             if verbose:
                 LOGINFO(
                     'using autofreq with %s frequency points, '
@@ -245,29 +490,66 @@ def stellingwerf_pdm(times,
                      1.0/frequencies.min())
                 )
 
-        # map to parallel workers
+        # renormalize the working mags to zero and scale them so that the
+        # variance = 1 for use with our LSP functions
+        if normalize:
+            nmags = (smags - npmedian(smags))/npstd(smags)
+        else:
+            nmags = smags
+
+        # get the times relative to the first time once here instead of for
+        # every frequency. these stay in float64 so the phases don't lose
+        # precision over long baselines, but theta is only used to rank
+        # periods, so float32 mags are enough and halve the memory traffic
+        dt = np.ascontiguousarray(stimes - stimes[0], dtype=np.float64)
+        nmags32 = np.ascontiguousarray(nmags, dtype=np.float32)
+
+        # the phase bins are uniform, so we only need their number
+        nbins = int(npceil(1.0/phasebinsize))
+
         if (not nworkers) or (nworkers > NCPUS):
             nworkers = NCPUS
             if verbose:
                 LOGINFO('using %s workers...' % nworkers)
 
-        pool = Pool(nworkers)
+        # if we have numba, run the whole frequency grid in one go using its
+        # threads
+        if HAVENUMBA:
 
-        # renormalize the working mags to zero and scale them so that the
-        # variance = 1 for use with our LSP functions
-        if normalize:
-            nmags = (smags - npmedian(smags))/npstd(smags)
+            if verbose:
+                LOGINFO('using numba to calculate PDM thetas...')
+
+            # use only nworkers threads, since we may be running in one of
+            # many parallel period-finding processes (e.g. lcproc.parallel_pf)
+            prevnthreads = get_num_threads()
+            set_num_threads(min(nworkers, numbaconfig.NUMBA_NUM_THREADS))
+
+            try:
+                lsp = _pdm_theta_grid(dt,
+                                      nmags32,
+                                      frequencies.astype(np.float64),
+                                      nbins,
+                                      mindetperbin)
+            finally:
+                set_num_threads(prevnthreads)
+
+        # otherwise, map to parallel workers
         else:
-            nmags = smags
 
-        tasks = [(stimes, nmags, serrs, x, phasebinsize, mindetperbin)
-                 for x in frequencies]
+            # send the light curve to each worker once instead of with every
+            # frequency task
+            pool = Pool(nworkers,
+                        initializer=_pdm_init,
+                        initargs=(dt, nmags32, nbins, mindetperbin))
 
-        lsp = pool.map(stellingwerf_pdm_worker, tasks)
+            # send each worker a few large chunks of the frequency grid
+            # instead of one frequency at a time
+            chunks = np.array_split(frequencies, nworkers*4)
+            lsp = np.concatenate(pool.map(_pdm_chunk_worker, chunks))
 
-        pool.close()
-        pool.join()
-        del pool
+            pool.close()
+            pool.join()
+            del pool
 
         lsp = nparray(lsp)
         periods = 1.0/frequencies
@@ -310,43 +592,56 @@ def stellingwerf_pdm(times,
                               'nbestpeaks':nbestpeaks,
                               'sigclip':sigclip}}
 
-        sortedlspind = np.argsort(finlsp)
-        sortedlspperiods = finperiods[sortedlspind]
-        sortedlspvals = finlsp[sortedlspind]
+        # we only need the lowest few lsp values to find the nbestpeaks, so
+        # partition the lsp array instead of sorting all of it. if there aren't
+        # enough well-separated peaks among these candidates, we'll try again
+        # with more of them
+        ncandidates = nbestpeaks*20
+
+        while True:
+
+            if ncandidates < finlsp.size:
+                candidateind = np.argpartition(finlsp,
+                                               ncandidates)[:ncandidates]
+                sortedlspind = candidateind[npargsort(finlsp[candidateind])]
+            else:
+                sortedlspind = npargsort(finlsp)
+
+            sortedlspperiods = finperiods[sortedlspind]
+            sortedlspvals = finlsp[sortedlspind]
+
+            # now get the nbestpeaks
+            nbestperiods, nbestlspvals, peakcount = (
+                [finperiods[bestperiodind]],
+                [finlsp[bestperiodind]],
+                1
+            )
+            prevperiod = sortedlspperiods[0]
 
-        prevbestlspval = sortedlspvals[0]
+            # find the best nbestpeaks in the lsp and their periods
+            for period, lspval in zip(sortedlspperiods, sortedlspvals):
 
-        # now get the nbestpeaks
-        nbestperiods, nbestlspvals, peakcount = (
-            [finperiods[bestperiodind]],
-            [finlsp[bestperiodind]],
-            1
-        )
-        prevperiod = sortedlspperiods[0]
+                if peakcount == nbestpeaks:
+                    break
+                perioddiff = abs(period - prevperiod)
+                bestperiodsdiff = npabs(nparray(nbestperiods) - period)
 
-        # find the best nbestpeaks in the lsp and their periods
-        for period, lspval in zip(sortedlspperiods, sortedlspvals):
+                # this ensures that this period is different from the last
+                # period and from all the other existing best periods by
+                # periodepsilon to make sure we jump to an entire different
+                # peak in the periodogram
+                if (perioddiff > periodepsilon and
+                    bestperiodsdiff.min() > periodepsilon):
+                    nbestperiods.append(period)
+                    nbestlspvals.append(lspval)
+                    peakcount = peakcount + 1
 
-            if peakcount == nbestpeaks:
+                prevperiod = period
+
+            if peakcount == nbestpeaks or sortedlspind.size == finlsp.size:
                 break
-            perioddiff = abs(period - prevperiod)
-            bestperiodsdiff = [abs(period - x) for x in nbestperiods]
-
-            # print('prevperiod = %s, thisperiod = %s, '
-            #       'perioddiff = %s, peakcount = %s' %
-            #       (prevperiod, period, perioddiff, peakcount))
-
-            # this ensures that this period is different from the last
-            # period and from all the other existing best periods by
-            # periodepsilon to make sure we jump to an entire different peak
-            # in the periodogram
-            if (perioddiff > periodepsilon and
-                all(x > periodepsilon for x in bestperiodsdiff)):
-                nbestperiods.append(period)
-                nbestlspvals.append(lspval)
-                peakcount = peakcount + 1
-
-            prevperiod = period
+
+            ncandidates = ncandidates*4
 
 
         return {'bestperiod':finperiods[bestperiodind],
@@ -0,0 +1,168 @@
+'''test_checkplot_pickle.py - License: MIT - see the LICENSE file for details.
+
+This tests reading and writing checkplot pickles in astrobase.checkplot:
+
+- write -> read round trips for plain, gzipped, and zstd-compressed pickles
+- the output filename when converting a checkplot pickle to zstd
+- the error when reading a zstd pickle without the zstandard package
+- the gzip fallback when writing a zstd pickle without the zstandard package
+
+These run in under a second.
+
+'''
+from __future__ import print_function
+
+import os.path
+
+import numpy as np
+from numpy.testing import assert_array_equal
+import pytest
+
+from astrobase import checkplot
+
+
+############
+## CONFIG ##
+############
+
+def make_cpdict():
+    '''
+    This makes a small dict that looks like a checkplot dict.
+
+    '''
+
+    return {'objectid':'test-object',
+            'objectinfo':{'ndet':10, 'bmag':None},
+            'magseries':{'times':np.linspace(0.0, 1.0, 10),
+                         'mags':np.arange(10.0)},
+            'status':'ok'}
+
+
+
+def check_cpdict(cpdict):
+    '''
+    This checks a dict read back from a pickle against the one from
+    make_cpdict.
+
+    '''
+
+    cpd = make_cpdict()
+
+    assert cpdict['objectid'] == cpd['objectid']
+    assert cpdict['objectinfo'] == cpd['objectinfo']
+    assert cpdict['status'] == cpd['status']
+    assert_array_equal(cpdict['magseries']['times'],
+                       cpd['magseries']['times'])
+    assert_array_equal(cpdict['magseries']['mags'],
+                       cpd['magseries']['mags'])
+
+
+###########
+## TESTS ##
+###########
+
+@pytest.mark.parametrize('outfname, kwargs, magic', [
+    ('checkplot.pkl', {}, None),
+    ('checkplot.pkl.gz', {'outgzip':True}, checkplot.GZIPMAGIC),
+    ('checkplot.pkl.zst', {'outzstd':True}, checkplot.ZSTDMAGIC),
+])
+def test_pickle_roundtrip(tmpdir, outfname, kwargs, magic):
+    '''
+    This writes a checkplot pickle and reads it back.
+
+    '''
+
+    if kwargs.get('outzstd'):
+        pytest.importorskip('zstandard')
+
+    outfile = checkplot._write_checkplot_picklefile(
+        make_cpdict(),
+        outfile=str(tmpdir.join(outfname)),
+        **kwargs
+    )
+    assert os.path.basename(outfile) == outfname
+
+    if magic is not None:
+        with open(outfile,'rb') as infd:
+            assert infd.read(len(magic)) == magic
+
+    check_cpdict(checkplot._read_checkplot_picklefile(outfile))
+
+
+
+@pytest.mark.parametrize('infname', ['checkplot.pkl.gz', 'checkplot.pkl'])
+def test_pickle_update_to_zstd(tmpdir, infname):
+    '''
+    This checks that converting a checkplot pickle to zstd writes to a .zst
+    file and leaves the original alone.
+
+    '''
+
+    pytest.importorskip('zstandard')
+
+    infile = checkplot._write_checkplot_picklefile(
+        make_cpdict(),
+        outfile=str(tmpdir.join(infname)),
+        outgzip=infname.endswith('.gz')
+    )
+
+    outfile = checkplot.checkplot_pickle_update(infile, {},
+                                                outzstd=True,
+                                                verbose=False)
+
+    assert os.path.basename(outfile) == 'checkplot.pkl.zst'
+    with open(outfile,'rb') as infd:
+        assert infd.read(4) == checkplot.ZSTDMAGIC
+
+    check_cpdict(checkplot._read_checkplot_picklefile(outfile))
+    check_cpdict(checkplot._read_checkplot_picklefile(infile))
+
+
+
+def test_read_zstd_without_zstandard(tmpdir, monkeypatch):
+    '''
+    This checks that reading a zstd pickle without zstandard raises an error
+    instead of returning None.
+
+    '''
+
+    pytest.importorskip('zstandard')
+
+    outfile = checkplot._write_checkplot_picklefile(
+        make_cpdict(),
+        outfile=str(tmpdir.join('checkplot.pkl.zst'))
+    )
+
+    monkeypatch.setattr(checkplot, 'HAVEZSTD', False)
+
+    with pytest.raises(IOError):
+        checkplot._read_checkplot_picklefile(outfile)
+
+
+
+@pytest.mark.parametrize('outfname, kwargs', [
+    ('checkplot.pkl.zst', {}),
+    ('checkplot.pkl', {'outzstd':True}),
+    (None, {'outzstd':True}),
+])
+def test_write_zstd_without_zstandard(tmpdir, monkeypatch, outfname, kwargs):
+    '''
+    This checks that writing a zstd pickle without zstandard writes a gzipped
+    pickle to a .gz file instead.
+
+    '''
+
+    monkeypatch.setattr(checkplot, 'HAVEZSTD', False)
+    monkeypatch.chdir(str(tmpdir))
+
+    outfile = checkplot._write_checkplot_picklefile(
+        make_cpdict(),
+        outfile=outfname,
+        **kwargs
+    )
+
+    assert outfile.endswith('.pkl.gz')
+    with open(outfile,'rb') as infd:
+        assert infd.read(2) == checkplot.GZIPMAGIC
+
+    check_cpdict(checkplot._read_checkplot_picklefile(outfile))
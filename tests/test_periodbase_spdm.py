@@ -0,0 +1,316 @@
+'''test_periodbase_spdm.py - License: MIT - see the LICENSE file for details.
+
+This tests the astrobase.periodbase.spdm module using a synthetic light curve:
+
+- the numba sigclip kernel against astrobase.lcmath.sigclip_magseries
+- sigclip = 0.0 meaning no sigclip in stellingwerf_pdm
+- the nbestpeaks selection against a full sort of the periodogram
+- the PDM theta kernels and both stellingwerf_pdm backends against a
+  per-bin variance definition of theta
+
+These run in a few seconds.
+
+'''
+from __future__ import print_function
+
+import multiprocessing
+
+import numpy as np
+from numpy.testing import assert_array_equal, assert_allclose
+import pytest
+
+from astrobase.lcmath import sigclip_magseries
+from astrobase.periodbase import spdm
+
+
+############
+## CONFIG ##
+############
+
+# this is the period of the synthetic light curve
+LCPERIOD = 2.3
+
+def make_lc(ndets=2000, seed=42):
+    '''
+    This makes a sinusoidal light curve with some NaNs and outliers in it.
+
+    '''
+
+    rng = np.random.RandomState(seed)
+
+    times = np.sort(rng.uniform(0.0, 60.0, ndets))
+    mags = (12.0 + 0.1*np.sin(2.0*np.pi*times/LCPERIOD) +
+            rng.normal(0.0, 0.02, ndets))
+    errs = np.full_like(times, 0.02)
+
+    mags[rng.randint(0, ndets, 20)] += rng.choice([-1.0, 1.0], 20)
+    mags[::97] = np.nan
+    times[::131] = np.nan
+    errs[::151] = np.nan
+
+    return times, mags, errs
+
+
+
+def fullsort_nbestpeaks(lspvals, periods, nbestpeaks, periodepsilon):
+    '''
+    This finds the nbestpeaks by sorting the whole periodogram. This is how
+    stellingwerf_pdm used to do it.
+
+    '''
+
+    finind = np.isfinite(lspvals)
+    finlsp = lspvals[finind]
+    finperiods = periods[finind]
+
+    bestperiodind = np.argmin(finlsp)
+    sortedlspind = np.argsort(finlsp)
+    sortedlspperiods = finperiods[sortedlspind]
+    sortedlspvals = finlsp[sortedlspind]
+
+    nbestperiods = [finperiods[bestperiodind]]
+    nbestlspvals = [finlsp[bestperiodind]]
+    prevperiod = sortedlspperiods[0]
+
+    for period, lspval in zip(sortedlspperiods, sortedlspvals):
+
+        if len(nbestperiods) == nbestpeaks:
+            break
+
+        if (abs(period - prevperiod) > periodepsilon and
+            all(abs(period - x) > periodepsilon for x in nbestperiods)):
+            nbestperiods.append(period)
+            nbestlspvals.append(lspval)
+
+        prevperiod = period
+
+    return nbestperiods, nbestlspvals
+
+
+
+def make_clean_lc(ndets=1500, seed=7, sort=True):
+    '''
+    This makes a sinusoidal light curve without NaNs or outliers, optionally
+    with the times in random order.
+
+    '''
+
+    rng = np.random.RandomState(seed)
+
+    times = rng.uniform(0.0, 60.0, ndets)
+    if sort:
+        times = np.sort(times)
+
+    mags = (12.0 + 0.1*np.sin(2.0*np.pi*times/LCPERIOD) +
+            rng.normal(0.0, 0.02, ndets))
+    errs = np.full_like(times, 0.02)
+
+    return times, mags, errs
+
+
+
+def reference_pdm_theta(times, mags, frequency, nbins, minbin):
+    '''
+    This calculates the Stellingwerf PDM theta directly from its definition:
+    the (ddof=1) variances of the mags in each phase bin with more than minbin
+    points, weighted by their (ndet - 1) and normalized by the (ddof=1)
+    variance of all the mags. The epoch is times[0].
+
+    '''
+
+    phases = ((times - times[0])*frequency) % 1.0
+    binind = np.minimum((phases*nbins).astype(int), nbins - 1)
+
+    binvariances, binndets = [], []
+
+    for x in range(nbins):
+        thisbin_mags = mags[binind == x]
+        if thisbin_mags.size > minbin:
+            binvariances.append(np.var(thisbin_mags, ddof=1))
+            binndets.append(thisbin_mags.size)
+
+    if not binndets:
+        return np.nan
+
+    binvariances = np.array(binvariances)
+    binndets = np.array(binndets)
+
+    theta_top = (np.sum(binvariances*(binndets - 1)) /
+                 (np.sum(binndets) - binndets.size))
+
+    return theta_top/np.var(mags, ddof=1)
+
+
+###########
+## TESTS ##
+###########
+
+@pytest.mark.skipif(not spdm.HAVENUMBA, reason='numba is not installed')
+@pytest.mark.parametrize('sigclip', [10.0, 5.0, 3.0, 1.0])
+def test_filter_sigclip(sigclip):
+    '''
+    This checks the numba sigclip kernel against sigclip_magseries.
+
+    '''
+
+    times, mags, errs = make_lc()
+
+    stimes, smags, serrs = spdm._filter_sigclip(times, mags, errs, sigclip)
+    rtimes, rmags, rerrs = sigclip_magseries(times, mags, errs,
+                                             sigclip=sigclip)
+
+    assert_array_equal(stimes, rtimes)
+    assert_array_equal(smags, rmags)
+    assert_array_equal(serrs, rerrs)
+
+
+
+def test_pdm_sigclip_zero():
+    '''
+    This checks that sigclip = 0.0 doesn't clip anything, like None.
+
+    '''
+
+    times, mags, errs = make_lc()
+
+    pdm_noclip = spdm.stellingwerf_pdm(times, mags, errs,
+                                       startp=1.0, endp=5.0,
+                                       sigclip=None, nworkers=2,
+                                       verbose=False)
+    pdm_zeroclip = spdm.stellingwerf_pdm(times, mags, errs,
+                                         startp=1.0, endp=5.0,
+                                         sigclip=0.0, nworkers=2,
+                                         verbose=False)
+
+    assert np.isfinite(pdm_zeroclip['bestperiod'])
+    assert pdm_zeroclip['bestperiod'] == pdm_noclip['bestperiod']
+    assert abs(pdm_zeroclip['bestperiod'] - LCPERIOD) < 0.01
+
+
+
+@pytest.mark.parametrize('nbestpeaks, periodepsilon',
+                         [(5, 0.1), (10, 0.1), (5, 0.5), (8, 0.4)])
+def test_pdm_nbestpeaks(nbestpeaks, periodepsilon):
+    '''
+    This checks the nbestpeaks found from the partitioned periodogram against
+    those from a full sort of it.
+
+    '''
+
+    times, mags, errs = make_lc()
+
+    pdm = spdm.stellingwerf_pdm(times, mags, errs,
+                                startp=1.0, endp=5.0,
+                                nbestpeaks=nbestpeaks,
+                                periodepsilon=periodepsilon,
+                                nworkers=2,
+                                verbose=False)
+
+    nbestperiods, nbestlspvals = fullsort_nbestpeaks(pdm['lspvals'],
+                                                     pdm['periods'],
+                                                     nbestpeaks,
+                                                     periodepsilon)
+
+    assert_array_equal(pdm['nbestperiods'], nbestperiods)
+    assert_array_equal(pdm['nbestlspvals'], nbestlspvals)
+
+
+
+@pytest.mark.parametrize('sort', [True, False])
+def test_pdm_theta(sort):
+    '''
+    This checks stellingwerf_pdm_theta against the reference theta, including
+    for unsorted times.
+
+    '''
+
+    times, mags, errs = make_clean_lc(sort=sort)
+    dt = times - times[0]
+
+    for frequency in np.linspace(0.2, 1.0, 25):
+
+        theta = spdm.stellingwerf_pdm_theta(dt, mags, frequency, 20, 9)
+        reftheta = reference_pdm_theta(times, mags, frequency, 20, 9)
+
+        assert_allclose(theta, reftheta, rtol=1.0e-10)
+
+
+
+@pytest.mark.skipif(not spdm.HAVENUMBA, reason='numba is not installed')
+@pytest.mark.parametrize('sort', [True, False])
+def test_pdm_theta_grid(sort):
+    '''
+    This checks the numba kernel against the reference theta, for float64 and
+    float32 mags, including for unsorted times.
+
+    '''
+
+    times, mags, errs = make_clean_lc(sort=sort)
+    dt = times - times[0]
+    freqs = np.linspace(0.2, 1.0, 600)
+
+    reflsp = np.array([reference_pdm_theta(times, mags, f, 20, 9)
+                       for f in freqs])
+
+    lsp64 = spdm._pdm_theta_grid(dt, mags, freqs, 20, 9)
+    assert_allclose(lsp64, reflsp, rtol=1.0e-8)
+
+    lsp32 = spdm._pdm_theta_grid(dt, mags.astype(np.float32), freqs, 20, 9)
+    assert_allclose(lsp32, reflsp, rtol=1.0e-5)
+
+
+
+@pytest.mark.parametrize('usenumba', [False, True])
+def test_pdm_backends(monkeypatch, usenumba):
+    '''
+    This checks the periodograms from stellingwerf_pdm against the reference
+    theta using the numba kernel and the multiprocessing pool.
+
+    '''
+
+    if usenumba and not spdm.HAVENUMBA:
+        pytest.skip('numba is not installed')
+
+    monkeypatch.setattr(spdm, 'HAVENUMBA', usenumba)
+
+    # numba's TBB threading layer deadlocks at exit if this process forks
+    # after running a parallel kernel, so use spawned pool workers here
+    if not usenumba and hasattr(multiprocessing, 'get_context'):
+        monkeypatch.setattr(spdm, 'Pool',
+                            multiprocessing.get_context('spawn').Pool)
+
+    times, mags, errs = make_clean_lc(sort=False)
+
+    pdm = spdm.stellingwerf_pdm(times, mags, errs,
+                                startp=1.0, endp=5.0,
+                                sigclip=None, nworkers=2,
+                                verbose=False)
+
+    reflsp = np.array([reference_pdm_theta(times, mags, 1.0/p, 20, 9)
+                       for p in pdm['periods']])
+
+    # stellingwerf_pdm uses float32 mags
+    assert_allclose(pdm['lspvals'], reflsp, rtol=1.0e-5)
+    assert abs(pdm['bestperiod'] - LCPERIOD) < 0.01
+
+
+
+def test_pdm_theta_nogoodbins():
+    '''
+    This checks that theta is NaN if no bin has more than minbin points.
+
+    '''
+
+    times, mags, errs = make_clean_lc(ndets=100)
+    dt = times - times[0]
+
+    # 100 points can't put more than 60 points into any of the 20 bins
+    with np.errstate(invalid='ignore', divide='ignore'):
+        theta = spdm.stellingwerf_pdm_theta(dt, mags, 0.5, 20, 60)
+
+    assert np.isnan(reference_pdm_theta(times, mags, 0.5, 20, 60))
+    assert np.isnan(theta)
+
+    if spdm.HAVENUMBA:
+        lsp = spdm._pdm_theta_grid(dt, mags, np.array([0.3, 0.5]), 20, 60)
+        assert np.all(np.isnan(lsp))